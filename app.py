@@ -4,6 +4,9 @@ import numpy as np
 from ultralytics import YOLO
 import tempfile
 import time
+import queue
+import threading
+from pipeline import CrowdPipeline, LatestSlot, ensure_engine
 
 # === 1. APP CONFIGURATION ===
 st.set_page_config(
@@ -114,9 +117,16 @@ st.markdown(f"""
 """, unsafe_allow_html=True)
 
 # === 4. HELPER FUNCTIONS ===
+BATCH = 8  # Frames per model.predict() call
+IMGSZ = 320  # Plenty for person counts, ~4x less compute than 640. Baked into the TensorRT engine
+INFER_EVERY = 3  # Run YOLO on every 3rd frame, reuse its boxes in between
+
+MODEL_PATH = 'yolo11n.pt'
+
 @st.cache_resource
 def load_model():
-    return YOLO('yolo11n.pt')
+    # TensorRT engine on CUDA machines, PyTorch weights otherwise
+    return YOLO(ensure_engine(MODEL_PATH, IMGSZ, BATCH, on_error=st.warning), task='detect')
 
 try:
     model = load_model()
@@ -136,37 +146,81 @@ def create_density_bar(count):
     # Returns: "24 Persons ██░░░░░░░░"
     return f"{count} People detected &nbsp; {bar}"
 
-def process_frame(frame):
-    # Aggressive Settings
-    results = model.predict(frame, conf=0.10, iou=0.90, imgsz=640, classes=[0], verbose=False)
-    
-    total_persons = 0
-    overlay = frame.copy()
-    
-    if results[0].boxes:
-        for box in results[0].boxes:
-            total_persons += 1
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            
-            box_color = (0, 255, 0) # Green
-            if total_persons > 20: box_color = (0, 165, 255) # Orange
-            if total_persons > 25: box_color = (0, 0, 255)   # Red
+# Crowd thresholds for the Streamlit views
+WARNING_LIMIT = 20
+CRITICAL_LIMIT = 25
 
-            cv2.rectangle(overlay, (x1, y1), (x2, y2), box_color, -1)
+def crowd_status(total_persons):
+    # Returns (status text, css class) for the status chip
+    if total_persons > CRITICAL_LIMIT:
+        return "CRITICAL RISK", "status-critical"
+    if total_persons > WARNING_LIMIT:
+        return "High Density", "status-warning"
+    return "Normal", "status-normal"
 
-    cv2.addWeighted(overlay, 0.4, frame, 0.6, 0, frame)
+# Largest size the video is shown at (see the stImage CSS above)
+DISPLAY_MAX_W = 850
+DISPLAY_MAX_H = 400
 
-    status_text = "Normal"
-    css_class = "status-normal"
-    
-    if total_persons > 25:
-        status_text = "CRITICAL RISK"
-        css_class = "status-critical"
-    elif total_persons > 20:
-        status_text = "High Density"
-        css_class = "status-warning"
-        
-    return frame, total_persons, status_text, css_class
+def fit_to_display(frame):
+    # Shrink to the on-screen size so fewer bytes get converted and uploaded
+    h, w = frame.shape[:2]
+    scale = min(DISPLAY_MAX_W / w, DISPLAY_MAX_H / h)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+def to_rgb(frame, rgb_buf):
+    # BGR -> RGB into a reused buffer instead of a fresh array every frame
+    if rgb_buf is None or rgb_buf.shape != frame.shape:
+        rgb_buf = np.empty_like(frame)
+    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_buf)
+    return rgb_buf
+
+def frame_signature(frame):
+    # Cheap fingerprint from a sparse pixel grid, used to skip re-sending identical frames
+    if isinstance(frame, bytes):
+        return hash(frame)
+    return hash(frame[::16, ::16].tobytes())
+
+STALL_TIMEOUT = 0.25  # Seconds without a result before live view shows raw frames
+STOP_TIMEOUT = 2.0  # Seconds to wait for the workers to release the capture
+
+# Decode + inference run inside CrowdPipeline on background threads, so a
+# slow Streamlit repaint never blocks the next frame grab
+def start_workers(source, live):
+    # One set of workers per render loop; show_stream stops them when the loop
+    # exits (end of stream, rerun, or the tab being closed / refreshed)
+    if 'workers' not in st.session_state:
+        stop_event = threading.Event()
+        pipeline = CrowdPipeline(model, batch=BATCH, imgsz=IMGSZ, conf=0.10, iou=0.90,
+                                 warning_limit=WARNING_LIMIT, critical_limit=CRITICAL_LIMIT,
+                                 infer_every=INFER_EVERY, gpu_jpeg=True,
+                                 display_size=(DISPLAY_MAX_W, DISPLAY_MAX_H))
+        result_slot = LatestSlot(stop_event, overwrite=live)
+
+        def work():
+            try:
+                pipeline.run(source, lambda frame, count: result_slot.put((frame, count)), stop_event, live=live)
+            finally:
+                result_slot.put(None) # End of stream
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        st.session_state['workers'] = {'stop': stop_event, 'thread': thread,
+                                       'pipeline': pipeline, 'results': result_slot}
+    return st.session_state['workers']
+
+def stop_workers():
+    workers = st.session_state.pop('workers', None)
+    if workers:
+        workers['stop'].set()
+        # Wait for the capture to be released, or a rerun that reopens the
+        # camera right away can find it still busy
+        workers['thread'].join(STOP_TIMEOUT)
+        decode_thread = workers['pipeline'].decode_thread
+        if decode_thread:
+            decode_thread.join(STOP_TIMEOUT)
 
 # === 5. SIDEBAR ===
 with st.sidebar:
@@ -202,55 +256,86 @@ def show_home():
                     st.session_state['page'] = 'analysis'
                     st.rerun()
 
-def show_live():
-    c1, c2 = st.columns([1, 15])
-    with c1:
-        if st.button("⬅"):
-            st.session_state['page'] = 'home'
-            st.rerun()
-    with c2:
-        st.markdown("<h4 style='margin: 5px 0 0 0;'>📡 Live Surveillance Feed</h4>", unsafe_allow_html=True)
-
+def show_stream(source, live):
+    # Shared render loop for the live feed and uploaded videos
     status_placeholder = st.empty()
     video_placeholder = st.empty()
     
-    cap = cv2.VideoCapture(0)
+    workers = start_workers(source, live)
     
     frame_count = 0
     display_status = "Initializing..."
     display_density = "0 People ░░░░░░░░░░"
     display_css = "status-normal"
+    last_sig, last_count = None, None
+    rgb_buf = None  # Reused for every BGR -> RGB conversion
+    last_html = None
     
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret: 
-            st.error("Camera error.")
-            break
-            
-        processed_frame, count, status, css = process_frame(frame)
+    # Streamlit raises inside the loop when the session stops or reruns, so
+    # stop the workers here instead of leaving them decoding in the background
+    try:
+        while True:
+            try:
+                item = workers['results'].get(timeout=STALL_TIMEOUT if live else None)
+            except queue.Empty:
+                # Inference is stalled, keep the feed moving with the newest raw frame.
+                # None: inference already has it, keep the last annotated frame up
+                raw_frame = workers['pipeline'].latest_frame()
+                if raw_frame is not None:
+                    rgb_buf = to_rgb(fit_to_display(raw_frame), rgb_buf)
+                    video_placeholder.image(rgb_buf, channels="RGB", use_container_width=True)
+                continue
+            if item is None: break
+            processed_frame, count = item
+        
+            frame_count += 1
+            if frame_count % 10 == 0:
+                display_status, display_css = crowd_status(count)
+                display_density = create_density_bar(count)
         
-        frame_count += 1
-        if frame_count % 10 == 0:
-            display_status = status
-            display_density = create_density_bar(count)
-            display_css = css
+            # Only re-send the status chips when their text actually changed
+            html = f"""
+                <div class="status-container">
+                    <div class="status-box {display_css}">Stampede Chances: {display_status}</div>
+                    <div class="status-box">{display_density}</div>
+                </div>
+            """
+            if html != last_html:
+                status_placeholder.markdown(html, unsafe_allow_html=True)
+                last_html = html
         
-        status_placeholder.markdown(f"""
-            <div class="status-container">
-                <div class="status-box {display_css}">Stampede Chances: {display_status}</div>
-                <div class="status-box">{display_density}</div>
-            </div>
-        """, unsafe_allow_html=True)
+            # Nothing changed since the last upload, skip the conversion and resend
+            sig = frame_signature(processed_frame)
+            if sig == last_sig and count == last_count: continue
+            last_sig, last_count = sig, count
         
-        frame_rgb = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2RGB)
-        video_placeholder.image(frame_rgb, channels="RGB", use_container_width=True)
+            if isinstance(processed_frame, bytes):
+                # Already drawn, resized and JPEG-encoded on the GPU
+                video_placeholder.image(processed_frame, use_container_width=True)
+            else:
+                rgb_buf = to_rgb(fit_to_display(processed_frame), rgb_buf)
+                video_placeholder.image(rgb_buf, channels="RGB", use_container_width=True)
+    finally:
+        stop_workers()
 
-    cap.release()
+def show_live():
+    c1, c2 = st.columns([1, 15])
+    with c1:
+        if st.button("⬅"):
+            stop_workers()
+            st.session_state['page'] = 'home'
+            st.rerun()
+    with c2:
+        st.markdown("<h4 style='margin: 5px 0 0 0;'>📡 Live Surveillance Feed</h4>", unsafe_allow_html=True)
+
+    show_stream(0, live=True)
+    st.error("Camera error.")
 
 def show_analysis():
     c1, c2 = st.columns([1, 15])
     with c1:
         if st.button("⬅"):
+            stop_workers()
             st.session_state['page'] = 'home'
             st.session_state['video_source'] = None
             st.rerun()
@@ -258,40 +343,9 @@ def show_analysis():
         st.markdown("<h4 style='margin: 5px 0 0 0;'>📊 Media Analysis</h4>", unsafe_allow_html=True)
 
     tfile = tempfile.NamedTemporaryFile(delete=False)
-    tfile.write(st.session_state['video_source'].read())
-    cap = cv2.VideoCapture(tfile.name)
-    
-    status_placeholder = st.empty()
-    video_placeholder = st.empty()
-
-    frame_count = 0
-    display_status = "Initializing..."
-    display_density = "0 People ░░░░░░░░░░"
-    display_css = "status-normal"
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret: break
-        
-        processed_frame, count, status, css = process_frame(frame)
-        
-        frame_count += 1
-        if frame_count % 10 == 0:
-            display_status = status
-            display_density = create_density_bar(count)
-            display_css = css
-        
-        status_placeholder.markdown(f"""
-            <div class="status-container">
-                <div class="status-box {display_css}">Stampede Chances: {display_status}</div>
-                <div class="status-box">{display_density}</div>
-            </div>
-        """, unsafe_allow_html=True)
-        
-        frame_rgb = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2RGB)
-        video_placeholder.image(frame_rgb, channels="RGB", use_container_width=True)
-        
-    cap.release()
+    tfile.write(st.session_state['video_source'].getvalue())
+    tfile.close()
+    show_stream(tfile.name, live=False)
 
 # === 7. ROUTER ===
 if st.session_state['page'] == 'home':
@@ -0,0 +1,410 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from ultralytics import YOLO
+
+# Optional: Numba (pip install numba) compiles the box blending loop to native
+# code, which matters on the Pi where there is no GPU to hide Python overhead
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# torchvision (installed with ultralytics) >= 0.19 can JPEG-encode CUDA tensors
+try:
+    from torchvision.io import encode_jpeg
+except ImportError:
+    encode_jpeg = None
+
+# ==========================================
+# Shared capture -> YOLO -> overlay pipeline
+# used by app.py (Streamlit) and pi_stream.py (Fluvio)
+# ==========================================
+
+# BGR box colour lookup table, indexed by bucketed running count:
+# green, orange (warning), red (critical)
+BOX_COLORS = np.array([(0, 255, 0), (0, 165, 255), (0, 0, 255)], dtype=np.uint8)
+
+# A grab() slower than this had to wait for the camera, i.e. the frame is fresh
+FRESH_GRAB_SECONDS = 0.005
+MAX_STALE_GRABS = 8
+
+# Guards OPENCV_FFMPEG_CAPTURE_OPTIONS while open_capture temporarily sets it
+_env_lock = threading.Lock()
+
+if njit:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def blend_boxes(frame, boxes, colors, alpha):
+        # In-place frame = alpha * color + (1 - alpha) * frame inside each box.
+        # Boxes go in order (overlaps blend like the OpenCV path), rows in parallel
+        for i in range(boxes.shape[0]):
+            x1, y1, x2, y2 = boxes[i, 0], boxes[i, 1], boxes[i, 2], boxes[i, 3]
+            for y in prange(y1, y2):
+                for x in range(x1, x2):
+                    for c in range(3):
+                        frame[y, x, c] = np.uint8(alpha * colors[i, c] + (1 - alpha) * frame[y, x, c] + 0.5)
+else:
+    blend_boxes = None
+
+def ensure_engine(model_path, imgsz, batch, on_error=print, **export_kwargs):
+    # One-time export to a TensorRT FP16 engine on CUDA machines (desktop GPU or
+    # Jetson). Returns the path to load: the engine, or the PyTorch weights when
+    # there is no GPU or the export fails (reported through on_error).
+    # Size in the name so a stale 640 engine is never picked up
+    engine_path = f"{os.path.splitext(model_path)[0]}_{imgsz}.engine"
+    if os.path.exists(engine_path):
+        return engine_path
+    if not torch.cuda.is_available():
+        return model_path
+    try:
+        # dynamic=True so partial batches and stride-padded (non-square) frames still fit
+        exported = YOLO(model_path).export(format='engine', half=True, imgsz=imgsz, dynamic=True,
+                                           batch=batch, **export_kwargs)
+        os.replace(exported, engine_path)
+        return engine_path
+    except Exception as e:
+        on_error(f"TensorRT export failed, using PyTorch model: {e}")
+        return model_path
+
+def open_capture(source, hw_decode=True):
+    # Webcam indices are not FFmpeg sources, keep the default backend for them
+    if isinstance(source, int):
+        cap = cv2.VideoCapture(source)
+        # Driver keeps only the newest frame, so a read is never seconds old
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # USB webcams: MJPG (libjpeg-turbo) is cheaper than raw YUYV -> BGR.
+        # Ignored by cameras that do not offer it
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        return cap
+    if not hw_decode:
+        return cv2.VideoCapture(source)
+
+    # Older OpenCV builds ignore CAP_PROP_HW_ACCELERATION but honour this env
+    # var. It is process wide, so only set it around our own open (under a lock,
+    # Streamlit sessions open sources from several threads) and always restore it
+    with _env_lock:
+        old_options = os.environ.get("OPENCV_FFMPEG_CAPTURE_OPTIONS")
+        if old_options is None and torch.cuda.is_available():
+            os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "hwaccel;cuda"
+
+        # Hardware decoding (NVDEC / VAAPI / D3D11), if the build and GPU support it
+        cap = None
+        try:
+            cap = cv2.VideoCapture(source, cv2.CAP_FFMPEG, (cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY))
+            if not (cap.isOpened() and cap.grab()):
+                cap.release()
+                cap = None
+        except (cv2.error, AttributeError):
+            cap = None
+        finally:
+            if old_options is None:
+                os.environ.pop("OPENCV_FFMPEG_CAPTURE_OPTIONS", None)
+
+    if cap is not None:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return cap
+
+    # Software decoding fallback
+    return cv2.VideoCapture(source)
+
+class LatestSlot:
+    # Single-item buffer between two stages. Live feeds overwrite an item the
+    # consumer has not taken yet, so only the freshest frame is ever shown;
+    # video files wait for it to be taken so every frame still gets analysed
+    def __init__(self, stop_event, overwrite):
+        self._stop_event = stop_event
+        self._overwrite = overwrite
+        self._cond = threading.Condition()
+        self._latest = None
+        self._pending = False
+
+    def put(self, item):
+        with self._cond:
+            while self._pending and not self._overwrite and not self._stop_event.is_set():
+                self._cond.wait(0.1)
+            self._latest = item
+            self._pending = True
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending, timeout):
+                raise queue.Empty
+            self._pending = False
+            self._cond.notify_all()
+            return self._latest
+
+    def peek_pending(self, copy):
+        # copy(item) of the item the consumer has not taken yet, else None.
+        # Copied under the lock, so the consumer cannot start modifying it meanwhile
+        with self._cond:
+            return copy(self._latest) if self._pending and self._latest is not None else None
+
+class CrowdPipeline:
+    # Decodes on a background thread, runs YOLO on batches of frames and
+    # blends the person boxes into each frame. run() hands every annotated
+    # frame and its person count to on_result.
+    def __init__(self, model, batch=8, hw_decode=True, imgsz=640, conf=0.10, iou=0.90,
+                 warning_limit=20, critical_limit=25, max_fps=None, infer_every=1,
+                 gpu_jpeg=False, display_size=None):
+        self.model = model
+        self.batch = batch
+        self.infer_every = infer_every  # Run YOLO on every N-th frame only
+        self.hw_decode = hw_decode
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.warning_limit = warning_limit
+        self.critical_limit = critical_limit
+        self.max_fps = max_fps
+        # On CUDA, draw + resize to display_size (max w, h) + JPEG-encode on the GPU
+        # and hand on_result JPEG bytes instead of a BGR frame
+        self.gpu_jpeg = gpu_jpeg
+        self.display_size = display_size
+
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self._pinned = None  # Reused host staging buffer for GPU uploads
+        self._color_buf = None  # Reused solid-colour scratch for the OpenCV blend
+        self._frame_slot = None
+        self.decode_thread = None  # Set by run(); releases the capture when it ends
+        self._frame_index = 0
+        self._last_boxes = np.zeros((0, 5), dtype=np.int64)
+
+    def open(self, source):
+        return open_capture(source, self.hw_decode)
+
+    def grab_latest(self, cap):
+        # Live cameras queue frames while we are busy. Grabbing a queued frame
+        # returns at once, so keep grabbing (skipped frames are never retrieved)
+        # until one has to wait for the camera - that one is fresh.
+        # Returns False at end of stream.
+        for _ in range(MAX_STALE_GRABS):
+            start_time = time.time()
+            if not cap.grab(): return False
+            if time.time() - start_time > FRESH_GRAB_SECONDS: break
+        return True
+
+    def read_batches(self, cap, live=False, batch=None):
+        # Groups frames so YOLO runs once per batch instead of once per frame.
+        # Skipped frames are only grabbed, never retrieve()d. That saves the
+        # colour conversion (and the GPU download under hwaccel); on camera
+        # backends such as V4L2 it also saves the decode. FFmpeg decodes in grab()
+        batch = batch or self.batch
+        frames = deque(maxlen=batch)
+        next_time = 0
+        while cap.isOpened():
+            if self.max_fps and live:
+                # FPS LIMITER (e.g. to keep the Pi cool): keep grabbing until the
+                # next frame is due, then retrieve just that one
+                if not cap.grab(): break
+                while time.time() < next_time:
+                    if not cap.grab(): break
+                next_time = time.time() + 1 / self.max_fps
+            elif self.max_fps:
+                # Files do not run ahead on their own: wait instead of skipping,
+                # so every frame is still analysed, just at max_fps
+                time.sleep(max(0, next_time - time.time()))
+                if not cap.grab(): break
+                next_time = time.time() + 1 / self.max_fps
+            elif live:
+                if not self.grab_latest(cap): break
+            elif not cap.grab(): break
+
+            ret, frame = cap.retrieve()
+            if not ret: break
+            frames.append(frame)
+            if len(frames) == batch:
+                yield list(frames)
+                frames.clear()
+        # Flush the partial batch left at the end of a video
+        if frames:
+            yield list(frames)
+
+    def _upload(self, frames):
+        # Uploads the batch as NHWC BGR uint8 through a reused pinned buffer
+        shape = (len(frames),) + frames[0].shape
+        if self._pinned is None or self._pinned.shape[1:] != shape[1:]:
+            self._pinned = torch.empty((self.batch,) + shape[1:], dtype=torch.uint8, pin_memory=True)
+        staged = self._pinned[:shape[0]]
+        np.stack(frames, out=staged.numpy())
+        return staged.to(self.device, non_blocking=True)
+
+    def _letterbox(self, batch):
+        # Letterboxes an uploaded batch on the GPU, so the CPU never resizes, pads
+        # or normalizes frames. Returns the model input plus the gain/padding
+        # needed to undo the letterbox.
+        h, w = batch.shape[1:3]
+
+        # NHWC BGR uint8 -> NCHW RGB float in [0, 1]
+        batch = batch.flip(-1).permute(0, 3, 1, 2).float() / 255
+
+        # Letterbox to imgsz, padded up to the model stride (32) like Ultralytics does
+        gain = min(self.imgsz / h, self.imgsz / w)
+        new_h, new_w = round(h * gain), round(w * gain)
+        pad_h, pad_w = -new_h % 32, -new_w % 32
+        top, left = pad_h // 2, pad_w // 2
+        batch = F.interpolate(batch, size=(new_h, new_w), mode='bilinear', align_corners=False)
+        batch = F.pad(batch, (left, pad_w - left, top, pad_h - top), value=114 / 255)
+        return batch, gain, (left, top)
+
+    def process_batch(self, frames):
+        # Returns [(annotated_frame, person_count), ...], one per input frame.
+        # Frames between two inference frames reuse the latest boxes, crowds
+        # barely move in a few frames
+        first = self._frame_index
+        self._frame_index += len(frames)
+        infer_at = [i for i in range(len(frames)) if (first + i) % self.infer_every == 0]
+
+        # GPU render needs every frame on the device, not only the inferred ones
+        uploaded = None
+        if self.gpu_jpeg and encode_jpeg and self.device == 'cuda':
+            uploaded = self._upload(frames)
+
+        detections = []
+        if infer_at:
+            subset = uploaded[infer_at] if uploaded is not None else None
+            detections = self.detect([frames[i] for i in infer_at], subset)
+        detections = iter(detections)
+
+        processed = []
+        for i, frame in enumerate(frames):
+            if (first + i) % self.infer_every == 0:
+                self._last_boxes = next(detections)
+            annotated = None
+            if uploaded is not None and self.gpu_jpeg:
+                annotated = self.render_jpeg(uploaded[i], self._last_boxes)
+            if annotated is None:
+                annotated = self.draw_boxes(frame, self._last_boxes)
+            processed.append((annotated, self._last_boxes.shape[0]))
+        return processed
+
+    def detect(self, frames, uploaded=None):
+        # Runs YOLO once on the batch; returns an (n, 5) box array per frame.
+        # uploaded: the same frames already on the GPU, if the caller has them
+        if self.device == 'cuda':
+            if uploaded is None:
+                uploaded = self._upload(frames)
+            inputs, gain, (left, top) = self._letterbox(uploaded)
+        else:
+            inputs, gain, (left, top) = frames, 1.0, (0, 0)
+
+        results = self.model.predict(inputs, conf=self.conf, iou=self.iou, imgsz=self.imgsz,
+                                     classes=[0], verbose=False)
+
+        # Colour index (BOX_COLORS row) for running counts:
+        # 0 up to warning_limit, 1 up to critical_limit, 2 above
+        color_bins = torch.tensor([self.warning_limit, self.critical_limit])
+
+        detections = []
+        for result in results:
+            # Map boxes back to frame coordinates and pick their colours while
+            # still on the device, then transfer everything in one .cpu() call
+            xyxy = result.boxes.xyxy
+            offset = torch.tensor([left, top, left, top], device=xyxy.device, dtype=xyxy.dtype)
+            xyxy = (xyxy - offset) / gain
+            count = torch.arange(1, xyxy.shape[0] + 1, device=xyxy.device)
+            color_idx = torch.bucketize(count, color_bins.to(xyxy.device))
+            detections.append(torch.cat([xyxy.round().long(), color_idx[:, None]], dim=1).cpu().numpy())
+        return detections
+
+    def draw_boxes(self, frame, boxes):
+        # boxes: (n, 5) int array of x1, y1, x2, y2, colour index
+        h, w = frame.shape[:2]
+        xyxy = boxes[:, :4].clip(0, (w, h, w, h))
+        colors = BOX_COLORS[boxes[:, 4]]
+
+        if blend_boxes:
+            blend_boxes(frame, np.ascontiguousarray(xyxy), colors, 0.4)
+            return frame
+
+        # Blend each box in place instead of copying and blending the whole frame.
+        # The solid colour patch is a view into one scratch buffer, no per-box allocation
+        if self._color_buf is None or self._color_buf.shape != frame.shape:
+            self._color_buf = np.empty_like(frame)
+        for (x1, y1, x2, y2), box_color in zip(xyxy.tolist(), colors.tolist()):
+            roi = frame[y1:y2, x1:x2]
+            if roi.size:
+                patch = self._color_buf[:roi.shape[0], :roi.shape[1]]
+                patch[:] = box_color
+                cv2.addWeighted(roi, 0.6, patch, 0.4, 0, roi)
+        return frame
+
+    def render_jpeg(self, image, boxes):
+        # GPU version of draw_boxes + display resize + JPEG encode. image is one
+        # uploaded HWC BGR uint8 frame; only the encoded bytes come back to the
+        # host. Returns None (caller falls back to draw_boxes) if this torchvision
+        # cannot encode on the GPU.
+        h, w = image.shape[:2]
+        image = image.flip(-1).permute(2, 0, 1).float() # CHW RGB
+
+        if boxes.shape[0]:
+            xyxy = boxes[:, :4].clip(0, (w, h, w, h))
+            colors = torch.from_numpy(BOX_COLORS[boxes[:, 4]][:, ::-1].copy()).to(image.device).float()
+            for (x1, y1, x2, y2), color in zip(xyxy.tolist(), colors):
+                roi = image[:, y1:y2, x1:x2]
+                roi.mul_(0.6).add_(0.4 * color[:, None, None])
+
+        if self.display_size:
+            scale = min(self.display_size[0] / w, self.display_size[1] / h)
+            if scale < 1:
+                image = F.interpolate(image[None], size=(int(h * scale), int(w * scale)),
+                                      mode='bilinear', antialias=True, align_corners=False)[0]
+
+        try:
+            jpeg = encode_jpeg(image.round().clamp_(0, 255).to(torch.uint8), quality=75)
+        except (RuntimeError, ValueError):
+            # No CUDA JPEG encoder in this torchvision, stop trying
+            self.gpu_jpeg = False
+            return None
+        return jpeg.cpu().numpy().tobytes()
+
+    def latest_frame(self):
+        # Copy of the newest decoded frame inference has not picked up yet, for
+        # when inference stalls. None once it was taken: draw_boxes is then
+        # blending into it in place, so it must not be shown half drawn
+        if self._frame_slot is None:
+            return None
+        return self._frame_slot.peek_pending(lambda frames: frames[-1].copy())
+
+    def _decode(self, cap, stop_event, live):
+        # Live feeds infer one frame at a time: waiting to fill a batch would
+        # delay every result by batch / fps (~270 ms for 8 frames at 30 fps)
+        try:
+            for frames in self.read_batches(cap, live, batch=1 if live else None):
+                if stop_event.is_set(): break
+                self._frame_slot.put(frames)
+        finally:
+            cap.release()
+            self._frame_slot.put(None) # End of stream
+
+    def run(self, source, on_result, stop_event=None, live=False):
+        # source: camera index, file path / URL, or an already opened VideoCapture.
+        # live=True drops stale frames instead of waiting for inference.
+        stop_event = stop_event or threading.Event()
+        cap = source if isinstance(source, cv2.VideoCapture) else self.open(source)
+        self._frame_slot = LatestSlot(stop_event, overwrite=live)
+        self.decode_thread = threading.Thread(target=self._decode, args=(cap, stop_event, live), daemon=True)
+        self.decode_thread.start()
+
+        try:
+            while not stop_event.is_set():
+                try:
+                    frames = self._frame_slot.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if frames is None: break
+                for frame, count in self.process_batch(frames):
+                    on_result(frame, count)
+        except BaseException:
+            # Stops the decode thread if on_result raised. Not on a normal end of
+            # stream: callers share stop_event, and a set event would let them
+            # overwrite the last result before it was taken
+            stop_event.set()
+            raise